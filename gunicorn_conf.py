@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+
+from uvicorn_worker import UvicornWorker
+
+
+class UvloopWorker(UvicornWorker):
+    # Fail loudly if the C-accelerated loop or parser is missing instead of falling back
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", (2 * multiprocessing.cpu_count()) + 1))
+worker_class = "gunicorn_conf.UvloopWorker"
+
+# Each worker opens its own Motor pool, so split a budget of ~100 connections between them.
+# The floor of 5 means the total exceeds 100 beyond 20 workers (workers * 5).
+# Each worker also has its own bcrypt thread pool, so split the CPUs the same way.
+raw_env = [
+    f"MONGO_POOL={os.getenv('MONGO_POOL', max(5, 100 // workers))}",
+    f"BCRYPT_THREADS={os.getenv('BCRYPT_THREADS', max(1, multiprocessing.cpu_count() // workers))}",
+]
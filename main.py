@@ -1,36 +1,128 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query, Request
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from pydantic import AliasChoices, BaseModel, BeforeValidator, EmailStr, Field, PlainValidator, WithJsonSchema, model_validator
+from typing import Annotated, List, Optional
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, WriteConcern
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from passlib.context import CryptContext
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
+import jwt
+from datetime import timedelta
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
 # --- MongoDB Setup ---
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-client = AsyncIOMotorClient(MONGO_URI)
-db = client["simple_app"]
-items_collection = db["items"]
-users_collection = db["users"]
+# Each worker process has its own pool, so keep it small
+MONGO_POOL = int(os.getenv("MONGO_POOL", "20"))
+# zstd needs the pymongo[zstd] extra from requirements.txt; listing a compressor whose
+# module is missing makes the driver warn on every client creation
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd")
+
+# Set up by the lifespan handler below
+client: Optional[AsyncIOMotorClient] = None
+db = None
+items_collection = None
+users_collection = None
+
+# Only the fields ItemOut needs (_id is always returned)
+ITEM_PROJECTION = {"name": 1, "description": 1, "price": 1}
+MAX_ITEMS_PAGE = 1000
+# Only the fields UserInDB needs
+USER_PROJECTION = {"email": 1, "full_name": 1, "disabled": 1, "hashed_password": 1, "password_version": 1, "_id": 0}
 
 # --- JWT Setup ---
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")  # Change in production
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Built once at import instead of on every decode
+_SECRET_KEY_BYTES = SECRET_KEY.encode()
+_JWT_ALGORITHMS = [ALGORITHM]
+_JWT_DECODER = jwt.PyJWT(options={"verify_signature": True, "require": ["exp", "sub"]})
+
+# Machine-generated API keys are high-entropy, so a keyed HMAC is enough for them.
+# API-key accounts are disabled unless a dedicated API_KEY_SECRET is configured.
+API_KEY_SECRET = os.getenv("API_KEY_SECRET")
+API_KEY_HASH_PREFIX = "$hmac-sha256$"
+API_KEY_MIN_LENGTH = 32
+
+# Each extra round doubles bcrypt cost; lower values trade security for latency
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# OAuth2PasswordBearer with a minimal header parse; still documents the scheme in OpenAPI
+class BearerTokenScheme(OAuth2PasswordBearer):
+    async def __call__(self, request: Request) -> Optional[str]:
+        authorization = request.headers.get("authorization")
+        if authorization and authorization[:7].lower() == "bearer ":
+            return authorization[7:]
+        if not self.auto_error:
+            return None
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+oauth2_scheme = BearerTokenScheme(tokenUrl="token", scheme_name="OAuth2PasswordBearer")
+
+# Cache of bcrypt verdicts keyed by sha256(plain || hashed), so plaintexts are never held
+_VERIFY_CACHE = TTLCache(maxsize=4096, ttl=300)
+_VERIFY_CACHE_LOCK = asyncio.Lock()
+
+# bcrypt releases the GIL, so hashing in a pool keeps the event loop responsive.
+# With several worker processes, size this per worker (gunicorn_conf.py does) to
+# avoid running workers * CPUs hashing threads.
+BCRYPT_THREADS = int(os.getenv("BCRYPT_THREADS", os.cpu_count() or 1))
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=BCRYPT_THREADS)
+
+# Both user caches are per process. Another worker sees a change to a user (password
+# version, disabled, deletion) only after its entries age out, so USER_CACHE_TTL
+# seconds after the change plus up to USER_CACHE_TTL more for a stale entry re-cached
+# into the token cache. Keep it short.
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+
+# Cache of decoded tokens -> (user, exp); entries are also dropped once the token expires
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+
+# Users by email; tokens carry password_version ("pv"), checked whenever a token is decoded
+_USER_BY_EMAIL = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
 
 # --- Models ---
 
+def _parse_object_id(value) -> ObjectId:
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid ObjectId")
+
+def _object_id_hex(value):
+    # ObjectId.binary.hex() skips the formatting done by ObjectId.__str__
+    if isinstance(value, ObjectId):
+        return value.binary.hex()
+    return value
+
+# Path parameter parsed into an ObjectId once at the request boundary
+ObjectIdStr = Annotated[ObjectId, PlainValidator(_parse_object_id), WithJsonSchema({"type": "string"})]
+
 # User models
 class UserBase(BaseModel):
     email: EmailStr
@@ -39,9 +131,19 @@ class UserBase(BaseModel):
 
 class UserCreate(UserBase):
     password: str
+    is_api_key: bool = False
+
+    @model_validator(mode="after")
+    def check_api_key_length(self):
+        # A single HMAC is only safe for long random keys, never for user-chosen passwords
+        if self.is_api_key and len(self.password) < API_KEY_MIN_LENGTH:
+            raise ValueError(f"API keys must be at least {API_KEY_MIN_LENGTH} characters")
+        return self
 
 class UserInDB(UserBase):
     hashed_password: str
+    # Bump on every password change so tokens issued before it are rejected
+    password_version: int = 0
 
 class Token(BaseModel):
     access_token: str
@@ -57,75 +159,180 @@ class Item(BaseModel):
     price: float
 
 class ItemOut(Item):
-    id: str
+    # Validates straight from Mongo documents, where the id is an ObjectId under "_id"
+    id: Annotated[str, BeforeValidator(_object_id_hex)] = Field(validation_alias=AliasChoices("_id", "id"))
 
 # --- Helper Functions ---
 
-def item_helper(item) -> dict:
-    return {
-        "id": str(item["_id"]),
-        "name": item["name"],
-        "description": item.get("description"),
-        "price": item["price"]
-    }
+def item_helper(item) -> ItemOut:
+    return ItemOut.model_validate(item)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def _verify_cache_key(plain_password, hashed_password) -> bytes:
+    return hashlib.sha256(plain_password.encode() + hashed_password.encode()).digest()
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def _hash_api_key(api_key: str) -> str:
+    digest = hmac.new(API_KEY_SECRET.encode(), api_key.encode(), hashlib.sha256).hexdigest()
+    return API_KEY_HASH_PREFIX + digest
 
-async def get_user(email: str) -> Optional[UserInDB]:
-    user = await users_collection.find_one({"email": email})
+async def verify_password(plain_password, hashed_password):
+    if hashed_password.startswith(API_KEY_HASH_PREFIX):
+        if not API_KEY_SECRET:
+            return False
+        return hmac.compare_digest(_hash_api_key(plain_password), hashed_password)
+    # The key includes the stored hash, so a changed password never hits a stale entry
+    key = _verify_cache_key(plain_password, hashed_password)
+    async with _VERIFY_CACHE_LOCK:
+        cached = _VERIFY_CACHE.get(key)
+    if cached is not None:
+        return cached
+    loop = asyncio.get_running_loop()
+    verdict = await loop.run_in_executor(_BCRYPT_POOL, pwd_context.verify, plain_password, hashed_password)
+    async with _VERIFY_CACHE_LOCK:
+        _VERIFY_CACHE[key] = verdict
+    return verdict
+
+async def get_password_hash(password, is_api_key: bool = False):
+    if is_api_key:
+        return _hash_api_key(password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BCRYPT_POOL, pwd_context.hash, password)
+
+async def get_user(email: str, use_cache: bool = True) -> Optional[UserInDB]:
+    if use_cache:
+        cached = _USER_BY_EMAIL.get(email)
+        if cached is not None:
+            return cached
+    user = await users_collection.find_one({"email": email}, projection=USER_PROJECTION)
     if user:
-        return UserInDB(**user)
+        user = UserInDB(**user)
+        _USER_BY_EMAIL[email] = user
+        return user
+
+def invalidate_user(email: str) -> None:
+    # Only clears this process; other workers catch up within their cache TTLs
+    _USER_BY_EMAIL.pop(email, None)
+    for key, (user, _) in list(_USER_CACHE.items()):
+        if user.email == email:
+            _USER_CACHE.pop(key, None)
 
 async def authenticate_user(email: str, password: str):
-    user = await get_user(email)
+    # Always read the stored hash fresh so a password changed elsewhere is honoured
+    user = await get_user(email, use_cache=False)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=15))
+    # JWT exp is epoch seconds (RFC 7519), so skip building datetime objects
+    expire = int(time.time()) + (int(expires_delta.total_seconds()) if expires_delta else 900)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _SECRET_KEY_BYTES, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _token_cache_key(token: str) -> bytes:
+    # Hash the token so raw JWTs are not pinned in memory
+    return hashlib.sha256(token.encode()).digest()
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserBase:
+    key = _token_cache_key(token)
+    cached = _USER_CACHE.get(key)
+    if cached is not None:
+        user, exp = cached
+        if exp > time.time():
+            return user
+        _USER_CACHE.pop(key, None)
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        payload = _JWT_DECODER.decode(token, _SECRET_KEY_BYTES, algorithms=_JWT_ALGORITHMS)
+        # "require" guarantees sub is present
+        email: str = payload["sub"]
         token_data = TokenData(email=email)
-    except JWTError:
+    except jwt.PyJWTError:
         raise credentials_exception
+    password_version = payload.get("pv", 0)
     user = await get_user(token_data.email)
-    if user is None:
+    if user is not None and user.password_version != password_version:
+        user = await get_user(token_data.email, use_cache=False)
+    if user is None or user.password_version != password_version:
         raise credentials_exception
+    _USER_CACHE[key] = (user, payload["exp"])
     return user
 
+# --- Startup ---
+
+_email_index_ready = False
+
+async def ensure_email_index() -> bool:
+    # register relies on this index to reject duplicate emails. A failure here
+    # (existing duplicates, Mongo not up yet) must not stop startup, so it is retried
+    # on each registration until it succeeds.
+    global _email_index_ready
+    if _email_index_ready:
+        return True
+    try:
+        await users_collection.create_index("email", unique=True)
+    except PyMongoError:
+        logger.exception(
+            "Could not create the unique index on users.email; registration falls back to a "
+            "pre-insert email check until it exists. If users contain duplicate emails, "
+            "remove the duplicates."
+        )
+        return False
+    _email_index_ready = True
+    return True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, items_collection, users_collection
+    if BCRYPT_ROUNDS < 10:
+        logger.warning("BCRYPT_ROUNDS=%d is below 10; password hashes are weak", BCRYPT_ROUNDS)
+    # Created here so the client is bound to the worker's event loop
+    client = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_POOL,
+        minPoolSize=min(5, MONGO_POOL),
+        serverSelectionTimeoutMS=2000,
+        compressors=MONGO_COMPRESSORS,
+    )
+    db = client["simple_app"]
+    # Items are non-critical: acknowledge on the primary without waiting for the journal
+    items_collection = db.get_collection("items", write_concern=WriteConcern(w=1, j=False))
+    # Users keep the client's default (durable) write concern
+    users_collection = db["users"]
+    await ensure_email_index()
+    try:
+        yield
+    finally:
+        client.close()
+
+app = FastAPI(lifespan=lifespan)
+
 # --- Auth Routes ---
 
 @app.post("/register", status_code=201)
 async def register(user: UserCreate):
-    existing_user = await users_collection.find_one({"email": user.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = get_password_hash(user.password)
-    user_dict = user.dict()
+    if user.is_api_key and not API_KEY_SECRET:
+        raise HTTPException(status_code=400, detail="API key registration is not enabled")
+    if not await ensure_email_index():
+        # Without the unique index, keep the pre-insert check so duplicates are still rejected
+        if await users_collection.find_one({"email": user.email}, projection={"_id": 1}):
+            raise HTTPException(status_code=400, detail="Email already registered")
+    hashed_password = await get_password_hash(user.password, is_api_key=user.is_api_key)
+    user_dict = user.model_dump(exclude={"password", "is_api_key"})
     user_dict["hashed_password"] = hashed_password
-    user_dict.pop("password")
-    await users_collection.insert_one(user_dict)
+    user_dict["password_version"] = 0
+    try:
+        await users_collection.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    invalidate_user(user.email)
     return {"msg": "User registered successfully"}
 
 @app.post("/token", response_model=Token)
@@ -133,7 +340,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
-    access_token = create_access_token(data={"sub": user.email}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    access_token = create_access_token(data={"sub": user.email, "pv": user.password_version}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=UserBase)
@@ -144,35 +351,45 @@ async def read_users_me(current_user: UserBase = Depends(get_current_user)):
 
 @app.post("/items", response_model=ItemOut)
 async def create_item(item: Item, current_user: UserBase = Depends(get_current_user)):
-    new_item = await items_collection.insert_one(item.dict())
-    created_item = await items_collection.find_one({"_id": new_item.inserted_id})
-    return item_helper(created_item)
+    item_dict = item.model_dump()
+    await items_collection.insert_one(item_dict)
+    # insert_one adds the generated _id to item_dict, so no re-fetch is needed
+    return item_helper(item_dict)
 
 @app.get("/items", response_model=List[ItemOut])
-async def get_items(current_user: UserBase = Depends(get_current_user)):
-    items = []
-    async for item in items_collection.find():
-        items.append(item_helper(item))
-    return items
+async def get_items(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_ITEMS_PAGE),
+    current_user: UserBase = Depends(get_current_user),
+):
+    # Sorting on the indexed _id keeps skip/limit pages stable across requests
+    cursor = items_collection.find({}, projection=ITEM_PROJECTION).sort("_id", 1).skip(skip).limit(limit)
+    docs = await cursor.to_list(length=limit)
+    # Raw documents validate straight into ItemOut (it accepts _id), so FastAPI's
+    # response_model validation and JSON dump handle the whole page in pydantic-core
+    return docs
 
 @app.get("/items/{item_id}", response_model=ItemOut)
-async def get_item(item_id: str, current_user: UserBase = Depends(get_current_user)):
-    item = await items_collection.find_one({"_id": ObjectId(item_id)})
+async def get_item(item_id: ObjectIdStr, current_user: UserBase = Depends(get_current_user)):
+    item = await items_collection.find_one({"_id": item_id})
     if item:
         return item_helper(item)
     raise HTTPException(status_code=404, detail="Item not found")
 
 @app.put("/items/{item_id}", response_model=ItemOut)
-async def update_item(item_id: str, item: Item, current_user: UserBase = Depends(get_current_user)):
-    updated = await items_collection.update_one({"_id": ObjectId(item_id)}, {"$set": item.dict()})
-    if updated.modified_count:
-        updated_item = await items_collection.find_one({"_id": ObjectId(item_id)})
+async def update_item(item_id: ObjectIdStr, item: Item, current_user: UserBase = Depends(get_current_user)):
+    updated_item = await items_collection.find_one_and_update(
+        {"_id": item_id},
+        {"$set": item.model_dump()},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated_item:
         return item_helper(updated_item)
     raise HTTPException(status_code=404, detail="Item not found")
 
 @app.delete("/items/{item_id}")
-async def delete_item(item_id: str, current_user: UserBase = Depends(get_current_user)):
-    deleted = await items_collection.delete_one({"_id": ObjectId(item_id)})
+async def delete_item(item_id: ObjectIdStr, current_user: UserBase = Depends(get_current_user)):
+    deleted = await items_collection.delete_one({"_id": item_id})
     if deleted.deleted_count:
         return {"message": "Item deleted successfully"}
     raise HTTPException(status_code=404, detail="Item not found")